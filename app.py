@@ -1,14 +1,33 @@
+import asyncio
+import csv
+import hashlib
 import io
 import json
 import os
 import re
-from dataclasses import asdict, dataclass
-from typing import Any, Dict, List, Optional, Tuple
-
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from itertools import chain
+from subprocess import PIPE
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import diskcache
 import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
-from pdf2image import convert_from_bytes
+from PIL import ImageOps
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServiceUnavailable
+from pdf2image import convert_from_path, pdfinfo_from_path
+from rank_bm25 import BM25Okapi
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from tenacity import (
+    RetryCallState,
+    retry,
+    retry_if_exception_type,
+    wait_exponential_jitter,
+)
 try:
     from pypdf import PdfReader
 except ImportError as exc:
@@ -16,8 +35,16 @@ except ImportError as exc:
         "Missing dependency 'pypdf'. Install it with: pip install -r requirements.txt"
     ) from exc
 import pytesseract
+try:
+    # In-process workers run in parallel too; keep libtesseract's OpenMP single-threaded.
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    # Optional: without it, OCR shells out to the tesseract CLI.
+    PyTessBaseAPI = None
 
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 
 SYSTEM_PROMPT = (
     "You are a Senior IT Compliance Auditor (CISA/CISSP) specializing in SOC2 and ISO 27001 audits. "
@@ -35,6 +62,25 @@ class AuditRow:
     filename: str
     audit_finding: str
     evidence: str
+    # Set when the document exceeded the model's budget and only the most relevant
+    # passages were sent; shown in the UI, not in the report columns.
+    document_trimmed: bool = False
+
+
+REPORT_COLUMNS = ("Filename", "Audit Finding", "Evidence")
+
+
+def _report_csv_bytes(rows: List[AuditRow]) -> bytes:
+    # Encode row by row into one bytes buffer; no intermediate str of the whole report.
+    buf = io.BytesIO()
+    text = io.TextIOWrapper(buf, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(REPORT_COLUMNS)
+    for r in rows:
+        writer.writerow((r.filename, r.audit_finding, r.evidence))
+    # Detach so closing the wrapper later can't close the buffer under us.
+    text.detach()
+    return buf.getvalue()
 
 
 def _safe_str(exc: BaseException) -> str:
@@ -43,17 +89,63 @@ def _safe_str(exc: BaseException) -> str:
     return msg[:4000]
 
 
+# NUL/tab/CR become spaces in one translate pass, so the regex only has to find
+# runs of 2+ spaces (single spaces, the common case, never hit the callback) and 3+ newlines.
+_WHITESPACE_TO_SPACE = str.maketrans({"\x00": " ", "\t": " ", "\r": " "})
+_WHITESPACE_RUN_RE = re.compile(r"  +|\n{3,}")
+
+
+def _collapse_whitespace(m: "re.Match[str]") -> str:
+    return "\n\n" if m.group(0)[0] == "\n" else " "
+
+
 def _clean_text(text: str) -> str:
     # Light normalization to reduce prompt bloat; do not over-process.
-    text = text.replace("\x00", " ")
-    text = re.sub(r"[\t\r ]+", " ", text)
-    text = re.sub(r"\n{3,}", "\n\n", text)
-    return text.strip()
+    return _WHITESPACE_RUN_RE.sub(_collapse_whitespace, text.translate(_WHITESPACE_TO_SPACE)).strip()
+
+
+def _join_pages(texts: Iterable[str]) -> str:
+    # Writes non-empty pages into a single buffer instead of building a list to join.
+    buf = io.StringIO()
+    for t in texts:
+        if t:
+            buf.write(t)
+            buf.write("\n\n")
+    return buf.getvalue()
+
+
+def _page_text(page: Any) -> str:
+    return (page.extract_text() or "").strip()
+
+
+# Born-digital triage looks at this many leading pages before trusting pypdf for the whole file.
+_TRIAGE_PAGES = 2
+# Fontless leading pages with less text than this are taken as a scan: skip pypdf, OCR everything.
+_SCANNED_MAX_CHARS = 5
+
+
+def _has_fonts(page: Any) -> bool:
+    # Scanned pages are usually a bare image XObject; text-bearing pages reference fonts.
+    resources = page.get("/Resources")
+    if resources is None:
+        return False
+    return "/Font" in resources.get_object()
+
+
+def _scanned_fallback_text(reader: Optional[PdfReader]) -> str:
+    """Runs the full pypdf pass skipped by the scan shortcut; "" if there is nothing to salvage."""
+    if reader is None:
+        return ""
+    try:
+        return _join_pages(_page_text(page) for page in reader.pages)
+    except Exception:
+        return ""
 
 
 @st.cache_data(show_spinner=False)
 def extract_pdf_text(
-    pdf_bytes: bytes,
+    pdf_digest: str,
+    _pdf_bytes: bytes,
     *,
     filename: str,
     ocr_threshold_chars: int,
@@ -63,89 +155,554 @@ def extract_pdf_text(
 ) -> Tuple[str, bool]:
     """Extracts text from a PDF.
 
-    1) Try selectable text extraction via pypdf.
-    2) If extracted text is < ocr_threshold_chars, fall back to OCR.
+    1) If the first pages have almost no text and page 1 has no fonts, treat the PDF as
+       scanned and OCR every page without running pypdf over the rest of the file
+       (falling back to pypdf if OCR fails or finds nothing).
+    2) Try selectable text extraction via pypdf.
+    3) If the first page has fonts and the first pages yield >= ocr_threshold_chars,
+       treat the PDF as born-digital and skip OCR entirely.
+    4) Otherwise OCR only the pages whose text is < ocr_threshold_chars and splice
+       the OCR text back in page order.
 
     Caching note:
     - Streamlit can cache this as long as we pass *hashable* inputs.
-    - We cache on the PDF bytes + OCR settings (not on UploadedFile objects).
+    - We cache on the PDF's SHA-256 digest + OCR settings (not on UploadedFile objects).
+      The leading underscore tells Streamlit not to hash `_pdf_bytes` itself.
     """
-    extracted = ""
+    page_texts: List[str] = []
+    native_text: Optional[str] = None
+    scanned_reader: Optional[PdfReader] = None
     try:
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        pages: List[str] = []
-        for page in reader.pages:
-            t = page.extract_text() or ""
-            t = t.strip()
-            if t:
-                pages.append(t)
-        extracted = "\n\n".join(pages).strip()
+        reader = PdfReader(io.BytesIO(_pdf_bytes))
+        n_pages = len(reader.pages)
+        page_texts = [_page_text(reader.pages[i]) for i in range(min(_TRIAGE_PAGES, n_pages))]
+        has_fonts = bool(n_pages) and _has_fonts(reader.pages[0])
+        # Only leading pages with (almost) no text count as a scan; fonts just break the
+        # tie, since they can live in Form XObjects that _has_fonts doesn't look into.
+        # Checking past page 1 keeps an image-only cover from sending a text PDF to OCR.
+        scanned = (
+            n_pages
+            and not has_fonts
+            and all(len(t) < _SCANNED_MAX_CHARS for t in page_texts)
+        )
+        if scanned and ocr_threshold_chars > 0:
+            # Scanned: pypdf would only walk image content streams and return nothing.
+            page_texts = []
+            scanned_reader = reader
+        elif has_fonts and sum(len(t) for t in page_texts) >= ocr_threshold_chars:
+            # Born-digital: stream the remaining pages straight into the buffer.
+            rest = (_page_text(reader.pages[i]) for i in range(len(page_texts), n_pages))
+            native_text = _join_pages(chain(page_texts, rest))
+        else:
+            page_texts.extend(_page_text(reader.pages[i]) for i in range(len(page_texts), n_pages))
     except Exception:
-        # If PDF parsing fails, we'll let OCR attempt to salvage.
-        extracted = ""
-
-    if len(extracted) >= ocr_threshold_chars:
-        return _clean_text(extracted), False
-
-    # OCR fallback
-    ocr_text = ocr_pdf_text(
-        pdf_bytes,
-        dpi=ocr_dpi,
-        lang=ocr_lang,
-        poppler_path=poppler_path,
-    )
-    ocr_text = (ocr_text or "").strip()
-    if ocr_text:
-        return _clean_text(ocr_text), True
+        # If PDF parsing fails, we'll let OCR attempt to salvage every page.
+        page_texts = []
+        native_text = None
+        scanned_reader = None
+
+    if native_text is not None:
+        return _clean_text(native_text), False
+
+    if ocr_threshold_chars <= 0:
+        # A threshold of 0 disables OCR, even for unparseable or zero-page PDFs.
+        return _clean_text(_join_pages(page_texts)), False
+
+    if page_texts:
+        ocr_pages: Optional[Tuple[int, ...]] = tuple(
+            i for i, t in enumerate(page_texts) if len(t) < ocr_threshold_chars
+        )
+        if not ocr_pages:
+            return _clean_text(_join_pages(page_texts)), False
+    else:
+        # Scanned (or unparseable) PDF
+        ocr_pages = None
+
+    # OCR fallback, only for the pages that need it
+    try:
+        ocr_texts = ocr_pdf_text(
+            pdf_digest,
+            _pdf_bytes,
+            pages=ocr_pages,
+            dpi=ocr_dpi,
+            lang=ocr_lang,
+            poppler_path=poppler_path,
+        )
+    except Exception:
+        # OCR is best-effort for individual short pages: if tesseract/poppler is
+        # unavailable, keep the selectable text instead of failing the whole file.
+        if ocr_pages is None:
+            fallback = _scanned_fallback_text(scanned_reader)
+            if fallback:
+                return _clean_text(fallback), False
+            raise
+        if not any(page_texts):
+            raise
+        return _clean_text(_join_pages(page_texts)), False
+    if ocr_pages is None:
+        page_texts = [t.strip() for t in ocr_texts]
+        if not any(page_texts):
+            # The scan shortcut guessed wrong (or OCR found nothing): use pypdf after all.
+            fallback = _scanned_fallback_text(scanned_reader)
+            if fallback:
+                return _clean_text(fallback), False
+    else:
+        for i, t in zip(ocr_pages, ocr_texts):
+            # No OCR text found either; keep whatever pypdf had for that page.
+            page_texts[i] = t.strip() or page_texts[i]
+
+    return _clean_text(_join_pages(page_texts)), True
+
+
+def _ocr_concurrency() -> int:
+    # Total single-threaded OCR workers for the whole app (default: one per core).
+    try:
+        return max(1, int(os.getenv("OCR_CONCURRENCY", "")))
+    except ValueError:
+        return os.cpu_count() or 1
+
+
+@st.cache_resource(show_spinner=False)
+def _cpu_slots(budget: int) -> threading.BoundedSemaphore:
+    # One process-wide semaphore, so files OCR'd side by side share the budget
+    # instead of each starting a full set of tesseract processes (or poppler threads).
+    return threading.BoundedSemaphore(budget)
+
+
+# How often a shard re-checks for a free slot; polling (rather than blocking in a
+# thread) keeps the wait cancellable without leaking a slot.
+_SLOT_POLL_SECONDS = 0.05
+
+
+async def _acquire_slot(slots: threading.BoundedSemaphore) -> None:
+    while not slots.acquire(blocking=False):
+        await asyncio.sleep(_SLOT_POLL_SECONDS)
+
+
+def _acquire_slots(slots: threading.BoundedSemaphore, want: int) -> int:
+    """Blocks for one slot, then takes up to `want` in total without waiting; returns the count.
+
+    Only the first acquire blocks, so callers needing several slots can't deadlock
+    each other by holding partial sets.
+    """
+    slots.acquire()
+    held = 1
+    while held < want and slots.acquire(blocking=False):
+        held += 1
+    return held
+
+
+async def _atesseract_filelist(paths: List[str], *, lang: str) -> List[str]:
+    """OCRs several page images with a single tesseract process (file-list mode).
+
+    Running one process per shard pays tesseract's model initialisation once instead of
+    per page. The process only starts once it holds one of the app-wide CPU slots.
+    """
+    list_path = f"{paths[0]}.list.txt"
+    with open(list_path, "w", encoding="utf-8") as fh:
+        fh.write("\n".join(paths))
+    slots = _cpu_slots(_ocr_concurrency())
+    await _acquire_slot(slots)
+    try:
+        return await _run_tesseract(list_path, n_pages=len(paths), lang=lang)
+    finally:
+        slots.release()
+
+
+async def _run_tesseract(list_path: str, *, n_pages: int, lang: str) -> List[str]:
+    # pytesseract is only used for its (user-overridable) executable path.
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            pytesseract.pytesseract.tesseract_cmd,
+            list_path,
+            "stdout",
+            "-l",
+            lang,
+            stdout=PIPE,
+            stderr=PIPE,
+            # Parallel tesseracts must not each start an OpenMP team too, or they
+            # oversubscribe the CPU and run slower than a serial loop.
+            env={**os.environ, "OMP_THREAD_LIMIT": "1"},
+        )
+    except FileNotFoundError as exc:
+        raise pytesseract.TesseractNotFoundError() from exc
+    out, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise pytesseract.TesseractError(proc.returncode, err.decode("utf-8", errors="replace").strip())
+
+    # Tesseract ends every page with a form feed.
+    parts = out.decode("utf-8", errors="replace").split("\f")[:n_pages]
+    return parts + [""] * (n_pages - len(parts))
+
+
+async def _aocr_all(paths: List[str], *, lang: str) -> List[str]:
+    # One file-list process per shard. A lone file gets the whole budget; with several
+    # files in flight, _cpu_slots caps how many shards actually run at once.
+    n_shards = min(_ocr_concurrency(), len(paths))
+    size = -(-len(paths) // n_shards)
+    shards = [paths[i : i + size] for i in range(0, len(paths), size)]
+    results = await asyncio.gather(*(_atesseract_filelist(shard, lang=lang) for shard in shards))
+    return [text for shard_texts in results for text in shard_texts]
+
+
+class _TesserocrPool:
+    """Worker threads that each keep one PyTessBaseAPI for the life of the process.
+
+    The model is loaded the first time a worker OCRs a page and then reused for every
+    later page, PDF and retry. tesserocr releases the GIL while recognizing, so the
+    threads run in parallel.
+    """
+
+    def __init__(self, *, lang: str, datapath: Optional[str], workers: int) -> None:
+        self._kwargs: Dict[str, Any] = {"lang": lang}
+        if datapath:
+            self._kwargs["path"] = datapath
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tesserocr")
+
+    def _ocr_one(self, path: str) -> str:
+        # Created lazily rather than in an executor initializer so a bad lang/datapath
+        # surfaces as a normal exception instead of a permanently broken pool.
+        api = getattr(self._local, "api", None)
+        if api is None:
+            api = self._local.api = PyTessBaseAPI(**self._kwargs)
+        # Share the app-wide CPU budget with poppler rasterizing other files.
+        with _cpu_slots(_ocr_concurrency()):
+            api.SetImageFile(path)
+            return api.GetUTF8Text() or ""
+
+    def map(self, paths: List[str]) -> List[str]:
+        return list(self._executor.map(self._ocr_one, paths))
+
+
+@st.cache_resource(show_spinner=False)
+def _tesserocr_pool(lang: str, datapath: Optional[str], workers: int) -> _TesserocrPool:
+    # One pool per (lang, tessdata) for the whole process, shared by every file and session.
+    return _TesserocrPool(lang=lang, datapath=datapath, workers=workers)
+
+
+def _ocr_in_process(paths: List[str], *, lang: str) -> List[str]:
+    """OCRs page images with libtesseract via tesserocr; no subprocess per page."""
+    pool = _tesserocr_pool(lang, os.getenv("TESSDATA_PREFIX") or None, _ocr_concurrency())
+    return pool.map(paths)
+
+
+def _ocr_paths(paths: List[str], *, lang: str) -> List[str]:
+    if PyTessBaseAPI is not None:
+        return _ocr_in_process(paths, lang=lang)
+    # All shards are scheduled on one event loop and run side by side.
+    return asyncio.run(_aocr_all(paths, lang=lang))
+
+
+# Bump whenever rendering/preprocessing changes what OCR sees, so the disk cache
+# never serves text produced by an older pipeline. 2: binarized pages.
+_OCR_PIPELINE_VERSION = 2
+
+
+def _ocr_engine() -> str:
+    return "tesserocr" if PyTessBaseAPI is not None else "tesseract-cli"
+
+
+@st.cache_resource(show_spinner=False)
+def _ocr_disk_cache() -> diskcache.Cache:
+    # Second-level cache behind st.cache_data: survives restarts and can be shared
+    # between containers by pointing AUDITBOT_CACHE_DIR at a common volume.
+    return diskcache.Cache(os.getenv("AUDITBOT_CACHE_DIR", ".cache/auditbot"))
+
+
+# Pages that come back with less OCR text than this at the (fast) default DPI are
+# re-rendered once at _OCR_RETRY_DPI, which is what small or faint print needs.
+_OCR_RETRY_MIN_CHARS = 20
+_OCR_RETRY_DPI = 300
+
+
+def _poppler_threads() -> int:
+    try:
+        return max(1, int(os.getenv("POPPLER_THREADS", "")))
+    except ValueError:
+        return os.cpu_count() or 1
+
+
+def _page_batches(pages: Tuple[int, ...], size: int) -> List[Tuple[int, int]]:
+    """Groups 0-based pages into contiguous 1-based (first, last) ranges of at most `size` pages."""
+    batches: List[Tuple[int, int]] = []
+    for i in pages:
+        if batches and batches[-1][1] == i and batches[-1][1] - batches[-1][0] + 1 < size:
+            batches[-1] = (batches[-1][0], i + 1)
+        else:
+            batches.append((i + 1, i + 1))
+    return batches
+
+
+def _iter_page_images(
+    pdf_path: str,
+    pages: Optional[Tuple[int, ...]],
+    *,
+    dpi: int,
+    poppler_path: Optional[str],
+) -> Iterator[Any]:
+    """Yields PIL images for the given 0-based pages (all if None).
+
+    Pages are rendered in small contiguous batches, up to one poppler thread per page
+    (as free CPU slots allow), so rasterization runs in parallel while only a batch of
+    images is held in memory.
+    Batches render from the same file on disk, so the PDF is never copied per batch.
+    """
+    if pages is None:
+        info = pdfinfo_from_path(pdf_path, poppler_path=poppler_path or None)
+        pages = tuple(range(int(info["Pages"])))
+    threads = _poppler_threads()
+    slots = _cpu_slots(_ocr_concurrency())
+    for first, last in _page_batches(pages, threads):
+        # pdftoppm threads draw on the same app-wide budget as tesseract, so files
+        # rasterizing side by side don't each start a full set of threads.
+        held = _acquire_slots(slots, min(threads, last - first + 1))
+        try:
+            images = convert_from_path(
+                pdf_path,
+                dpi=dpi,
+                fmt="png",
+                first_page=first,
+                last_page=last,
+                poppler_path=poppler_path or None,
+                thread_count=held,
+            )
+        finally:
+            for _ in range(held):
+                slots.release()
+        yield from images
+
 
-    # No OCR text found either; return whatever we had.
-    return _clean_text(extracted), True
+# Cut-off applied after autocontrast stretches each page to the full 0-255 range.
+_BINARIZE_THRESHOLD = 180
+
+
+def _binarize(img: Any) -> Any:
+    """Grayscale + autocontrast + threshold to a 1-bit image.
+
+    Saves tesseract its own binarization pass, and 1-bit PNGs are far smaller to write
+    and read than RGB ones.
+    """
+    img = ImageOps.autocontrast(ImageOps.grayscale(img))
+    return img.point(lambda p: 255 if p > _BINARIZE_THRESHOLD else 0, mode="1")
+
+
+def _render_pages(
+    pdf_path: str,
+    pages: Optional[Tuple[int, ...]],
+    *,
+    dpi: int,
+    poppler_path: Optional[str],
+    out_dir: str,
+) -> List[str]:
+    """Rasterizes pages to PNG files in out_dir and returns their paths in page order.
+
+    Only one batch of page images is held in memory at a time, however long the PDF is.
+    """
+    paths: List[str] = []
+    for img in _iter_page_images(pdf_path, pages, dpi=dpi, poppler_path=poppler_path):
+        path = os.path.join(out_dir, f"{dpi}-{len(paths):05d}.png")
+        _binarize(img).save(path, format="PNG")
+        paths.append(path)
+    return paths
 
 
 @st.cache_data(show_spinner=False)
 def ocr_pdf_text(
-    pdf_bytes: bytes,
+    pdf_digest: str,
+    _pdf_bytes: bytes,
     *,
+    pages: Optional[Tuple[int, ...]],
     dpi: int,
     lang: str,
     poppler_path: Optional[str],
-) -> str:
-    images = convert_from_bytes(
-        pdf_bytes,
-        dpi=dpi,
-        fmt="png",
-        poppler_path=poppler_path or None,
+) -> List[str]:
+    """OCRs the given 0-based pages (all pages if None) and returns one string per page.
+
+    Cached on `pdf_digest`; like extract_pdf_text, `_pdf_bytes` is not hashed.
+    """
+    # Keyed by content plus pipeline version and engine, so entries need no expiry.
+    cache = _ocr_disk_cache()
+    key = f"v{_OCR_PIPELINE_VERSION}|{_ocr_engine()}|{pdf_digest}|{pages}|{dpi}|{lang}"
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    with tempfile.TemporaryDirectory(prefix="auditbot-ocr-") as work_dir:
+        # Write the PDF once; every poppler batch (and the retry) renders from this file.
+        pdf_path = os.path.join(work_dir, "input.pdf")
+        with open(pdf_path, "wb") as fh:
+            fh.write(_pdf_bytes)
+
+        paths = _render_pages(pdf_path, pages, dpi=dpi, poppler_path=poppler_path, out_dir=work_dir)
+        if not paths:
+            return []
+
+        texts = _ocr_paths(paths, lang=lang)
+
+        if dpi < _OCR_RETRY_DPI:
+            page_indices = list(range(len(texts))) if pages is None else list(pages)
+            retry = [k for k, t in enumerate(texts) if len(t.strip()) < _OCR_RETRY_MIN_CHARS]
+            if retry:
+                retry_paths = _render_pages(
+                    pdf_path,
+                    tuple(page_indices[k] for k in retry),
+                    dpi=_OCR_RETRY_DPI,
+                    poppler_path=poppler_path,
+                    out_dir=work_dir,
+                )
+                for k, t in zip(retry, _ocr_paths(retry_paths, lang=lang)):
+                    if len(t.strip()) > len(texts[k].strip()):
+                        texts[k] = t
+
+    cache.set(key, texts)
+    return texts
+
+
+# Built once at import, like the module-level regexes; raw_decode is stateless.
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _parse_json_response(text: str) -> Dict[str, Any]:
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as exc:
+        # JSON mode should make this unreachable. Otherwise return the first '{' that
+        # decodes to a complete object, so prose or examples around it don't matter.
+        start = text.find("{")
+        while start >= 0:
+            try:
+                obj, _ = _JSON_DECODER.raw_decode(text, start)
+                return obj
+            except json.JSONDecodeError:
+                start = text.find("{", start + 1)
+        raise exc
+
+
+# Per-model document budgets in chars (~4 chars/token), matched by name prefix. They
+# sit well below each context window to keep calls inside TPM limits and first-token
+# latency low; larger-context models get proportionally more of the document.
+_MODEL_DOCUMENT_CHARS: Tuple[Tuple[str, int], ...] = (
+    ("gemini-1.5-pro", 400_000),  # 2M-token context
+    ("gemini-2", 240_000),  # 1M-token context
+    ("gemini-1.5-flash", 60_000),  # ~15k tokens
+    ("gemini-pro", 60_000),  # 1.0 Pro: 32k-token context
+)
+_DEFAULT_MAX_DOCUMENT_CHARS = 60_000
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _max_document_chars(model_name: str) -> int:
+    # GEMINI_MAX_DOC_CHARS, when set, overrides the per-model budget.
+    default = next(
+        (chars for prefix, chars in _MODEL_DOCUMENT_CHARS if model_name.startswith(prefix)),
+        _DEFAULT_MAX_DOCUMENT_CHARS,
     )
-    parts: List[str] = []
-    for img in images:
-        parts.append(pytesseract.image_to_string(img, lang=lang) or "")
-    return "\n".join(parts)
+    try:
+        return max(1, int(os.getenv("GEMINI_MAX_DOC_CHARS", str(default))))
+    except ValueError:
+        return default
+
+
+def _tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _select_relevant_text(document_text: str, question: str, *, max_chars: int) -> str:
+    """Fits the document into max_chars by keeping the paragraphs BM25 ranks highest for the question.
+
+    Kept paragraphs are verbatim and stay in document order, so evidence quotes still match the PDF.
+    """
+    if len(document_text) <= max_chars:
+        return document_text
+
+    paragraphs = [p for p in document_text.split("\n\n") if p.strip()]
+    corpus = [_tokenize(p) for p in paragraphs]
+    query = _tokenize(question)
+    if not query or not any(corpus):
+        return document_text[:max_chars]
+
+    scores = BM25Okapi(corpus).get_scores(query)
+    ranked = sorted(range(len(paragraphs)), key=lambda i: scores[i], reverse=True)
 
+    keep: List[int] = []
+    budget = max_chars
+    for i in ranked:
+        cost = len(paragraphs[i]) + 2
+        if cost <= budget:
+            keep.append(i)
+            budget -= cost
+    if not keep:
+        # Even the best paragraph alone is over budget.
+        return paragraphs[ranked[0]][:max_chars]
 
-def _extract_json_object(text: str) -> Optional[Dict[str, Any]]:
-    # Gemini sometimes wraps JSON in prose/markdown. Extract first {...} block.
-    m = re.search(r"\{[\s\S]*\}", text)
-    if not m:
-        return None
+    return "\n\n".join(paragraphs[i] for i in sorted(keep))
+
+
+def _gemini_retries() -> int:
     try:
-        return json.loads(m.group(0))
-    except Exception:
-        return None
+        return max(1, int(os.getenv("GEMINI_RETRIES", "5")))
+    except ValueError:
+        return 5
 
 
-# REPLACE THE ENTIRE ask_gemini FUNCTION WITH THIS:
-def ask_gemini(*, api_key: str, model_name: str, document_text: str, question: str) -> AuditRow:
-    genai.configure(api_key=api_key)
+# 429s mean the per-minute token bucket is empty, so wait longer before trying again;
+# 503s/deadlines are usually momentary.
+_RATE_LIMIT_WAIT = wait_exponential_jitter(initial=5, max=60)
+_TRANSIENT_WAIT = wait_exponential_jitter(initial=1, max=30)
+
+
+def _gemini_backoff(retry_state: RetryCallState) -> float:
+    exc = retry_state.outcome.exception() if retry_state.outcome else None
+    wait = _RATE_LIMIT_WAIT if isinstance(exc, ResourceExhausted) else _TRANSIENT_WAIT
+    return wait(retry_state)
 
+
+@retry(
+    retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable, DeadlineExceeded)),
+    wait=_gemini_backoff,
+    # Read per call (not at import) so GEMINI_RETRIES from .env is honoured.
+    stop=lambda retry_state: retry_state.attempt_number >= _gemini_retries(),
+    reraise=True,
+)
+def _generate_content(model: genai.GenerativeModel, prompt: str) -> Any:
+    # Retry rate limits and transient outages instead of failing the row; anything
+    # else (bad key, blocked prompt, ...) is raised straight to ask_gemini.
+    return model.generate_content(prompt)
+
+
+@st.cache_resource(show_spinner=False)
+def _genai_configure_lock() -> threading.Lock:
+    # genai.configure() is process-global; one lock shared by every session and rerun.
+    return threading.Lock()
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _get_model(api_key: str, model_name: str) -> genai.GenerativeModel:
+    # Configured once per (key, model) and shared by every file and worker thread.
+    with _genai_configure_lock():
+        genai.configure(api_key=api_key)
+        # Configure model with JSON enforcement
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            system_instruction=SYSTEM_PROMPT,
+            generation_config={"response_mime_type": "application/json"}  # <--- THIS FORCES PERFECT JSON
+        )
+        # GenerativeModel otherwise binds the global client lazily on its first call,
+        # by which time another session may have configured a different key.
+        model._client = genai_client.get_default_generative_client()
+    return model
+
+
+def ask_gemini(*, api_key: str, model_name: str, document_text: str, question: str) -> AuditRow:
     if model_name.startswith("models/"):
         model_name = model_name[len("models/") :]
 
-    # Configure model with JSON enforcement
-    model = genai.GenerativeModel(
-        model_name=model_name,
-        system_instruction=SYSTEM_PROMPT,
-        generation_config={"response_mime_type": "application/json"}  # <--- THIS FORCES PERFECT JSON
-    )
+    model = _get_model(api_key, model_name)
+
+    max_chars = _max_document_chars(model_name)
+    trimmed = len(document_text) > max_chars
+    document_text = _select_relevant_text(document_text, question, max_chars=max_chars)
 
     user_prompt = (
         f"DOCUMENT CONTENT:\n{document_text}\n\n"
@@ -158,15 +715,16 @@ def ask_gemini(*, api_key: str, model_name: str, document_text: str, question: s
     )
 
     try:
-        resp = model.generate_content(user_prompt)
+        resp = _generate_content(model, user_prompt)
         
-        # Parse JSON directly (no more Regex needed)
-        parsed = json.loads(resp.text)
+        # JSON mode: parse directly, no regex scan over the response
+        parsed = _parse_json_response(resp.text)
         
         return AuditRow(
             filename="", 
             audit_finding=parsed.get("audit_finding", "Error parsing finding"), 
-            evidence=parsed.get("evidence", "EVIDENCE NOT FOUND")
+            evidence=parsed.get("evidence", "EVIDENCE NOT FOUND"),
+            document_trimmed=trimmed,
         )
 
     except Exception as e:
@@ -176,24 +734,94 @@ def ask_gemini(*, api_key: str, model_name: str, document_text: str, question: s
             evidence=_safe_str(e)
         )
 
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def _list_generate_content_models(api_key: str) -> List[str]:
+    # list_models() uses the global client too; consume it before releasing the lock.
+    with _genai_configure_lock():
+        genai.configure(api_key=api_key)
+        return [
+            str(getattr(m, "name", ""))
+            for m in genai.list_models()
+            if "generateContent" in (getattr(m, "supported_generation_methods", None) or [])
+        ]
+
+
 def choose_model(api_key: str, preferred: str) -> str:
     """Mirror the Java behavior lightly: allow an 'Auto' mode that selects a model supporting generateContent."""
     if preferred != "Auto (list models)":
         return preferred
 
-    genai.configure(api_key=api_key)
     try:
-        for m in genai.list_models():
-            methods = getattr(m, "supported_generation_methods", None) or []
-            if "generateContent" in methods:
-                # Names are typically like 'models/gemini-1.5-flash'
-                return str(getattr(m, "name", "gemini-1.5-flash"))
+        for name in _list_generate_content_models(api_key):
+            # Names are typically like 'models/gemini-1.5-flash'
+            if name:
+                return name
     except Exception:
         pass
 
     return "gemini-1.5-flash"
 
 
+def _audit_concurrency() -> int:
+    try:
+        return max(1, int(os.getenv("AUDIT_CONCURRENCY", "4")))
+    except ValueError:
+        return 4
+
+
+def _process_one_file(
+    f: Any,
+    *,
+    api_key: str,
+    model_name: str,
+    question: str,
+    ocr_threshold_chars: int,
+    ocr_dpi: int,
+    ocr_lang: str,
+    poppler_path: Optional[str],
+) -> AuditRow:
+    try:
+        pdf_bytes = f.getvalue()
+        # Hash once here; the caches below key on the digest instead of rehashing the bytes.
+        pdf_digest = hashlib.sha256(pdf_bytes).hexdigest()
+
+        doc_text, used_ocr = extract_pdf_text(
+            pdf_digest,
+            pdf_bytes,
+            filename=f.name,
+            ocr_threshold_chars=ocr_threshold_chars,
+            ocr_dpi=ocr_dpi,
+            ocr_lang=ocr_lang,
+            poppler_path=poppler_path,
+        )
+
+        if not doc_text:
+            raise RuntimeError(
+                "No text could be extracted from the PDF (selectable text + OCR both returned empty)."
+            )
+
+        result = ask_gemini(
+            api_key=api_key,
+            model_name=model_name,
+            document_text=doc_text,
+            question=question,
+        )
+        result.filename = f.name
+
+        # Intentionally keep Evidence as a pure quote from the document.
+        # (We don’t prepend notes like "[OCR used]" to avoid corrupting the quoted sentence.)
+
+        return result
+
+    except Exception as e:
+        return AuditRow(
+            filename=f.name,
+            audit_finding="ERROR",
+            evidence=_safe_str(e),
+        )
+
+
 def main() -> None:
     # Prefer a local, gitignored `.env` for secrets.
     load_dotenv()
@@ -243,9 +871,16 @@ def main() -> None:
             max_value=10000,
             value=50,
             step=10,
-            help="If extracted selectable text is shorter than this, OCR will run.",
+            help="Pages whose selectable text is shorter than this are OCR'd.",
+        )
+        ocr_dpi = st.number_input(
+            "OCR DPI",
+            min_value=100,
+            max_value=600,
+            value=200,
+            step=50,
+            help="Pages that OCR to almost nothing at lower DPI are retried once at 300 DPI.",
         )
-        ocr_dpi = st.number_input("OCR DPI", min_value=100, max_value=600, value=300, step=50)
         ocr_lang = st.text_input("Tesseract language", value="eng")
 
         tessdata_prefix = st.text_input(
@@ -285,7 +920,7 @@ def main() -> None:
 
     if not run:
         st.caption(
-            "Tip: For scanned PDFs, ensure Tesseract + Poppler are installed. OCR runs only when selectable text is < 50 chars."
+            "Tip: For scanned PDFs, ensure Tesseract + Poppler are installed. OCR runs only for pages with < 50 chars of selectable text."
         )
         return
 
@@ -295,66 +930,61 @@ def main() -> None:
 
     chosen_model = choose_model(api_key, model_choice)
 
-    rows: List[AuditRow] = []
     progress = st.progress(0)
 
-    for i, f in enumerate(files):
-        progress.progress((i) / max(len(files), 1))
-        try:
-            pdf_bytes = f.getvalue()
-
-            doc_text, used_ocr = extract_pdf_text(
-                pdf_bytes,
-                filename=f.name,
+    # Worker threads need the script context to use st.cache_data without warnings.
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=_audit_concurrency(),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    ) as ex:
+        futures = {
+            ex.submit(
+                _process_one_file,
+                f,
+                api_key=api_key,
+                model_name=chosen_model,
+                question=question.strip(),
                 ocr_threshold_chars=int(ocr_threshold_chars),
                 ocr_dpi=int(ocr_dpi),
                 ocr_lang=ocr_lang.strip() or "eng",
                 poppler_path=poppler_path.strip() or None,
-            )
-
-            if not doc_text:
-                raise RuntimeError(
-                    "No text could be extracted from the PDF (selectable text + OCR both returned empty)."
-                )
-
-            result = ask_gemini(
-                api_key=api_key,
-                model_name=chosen_model,
-                document_text=doc_text,
-                question=question.strip(),
-            )
-            result.filename = f.name
-
-            # Intentionally keep Evidence as a pure quote from the document.
-            # (We don’t prepend notes like "[OCR used]" to avoid corrupting the quoted sentence.)
-
-            rows.append(result)
+            ): i
+            for i, f in enumerate(files)
+        }
+        results: Dict[int, AuditRow] = {}
+        for done, fut in enumerate(as_completed(futures), start=1):
+            results[futures[fut]] = fut.result()
+            progress.progress(done / max(len(files), 1))
 
-        except Exception as e:
-            rows.append(
-                AuditRow(
-                    filename=f.name,
-                    audit_finding="ERROR",
-                    evidence=_safe_str(e),
-                )
-            )
+    # Keep the report in upload order regardless of completion order.
+    rows: List[AuditRow] = [results[i] for i in range(len(files))]
 
     progress.progress(1.0)
 
-    df = pd.DataFrame([asdict(r) for r in rows])
-    # Match requested column naming
-    df = df.rename(
-        columns={
-            "filename": "Filename",
-            "audit_finding": "Audit Finding",
-            "evidence": "Evidence",
+    # Match requested column naming; build columns directly rather than via asdict per row.
+    filename_col, finding_col, evidence_col = REPORT_COLUMNS
+    df = pd.DataFrame(
+        {
+            filename_col: [r.filename for r in rows],
+            finding_col: [r.audit_finding for r in rows],
+            evidence_col: [r.evidence for r in rows],
         }
     )
 
     st.subheader("Results")
     st.dataframe(df, use_container_width=True)
 
-    csv_bytes = df.to_csv(index=False).encode("utf-8")
+    trimmed_files = [r.filename for r in rows if r.document_trimmed]
+    if trimmed_files:
+        st.warning(
+            "Document text exceeded the model's input budget, so only the passages most "
+            "relevant to the question were sent for: "
+            + ", ".join(trimmed_files)
+            + ". A 'Gaps Observed' finding for these files may reflect text that was left out."
+        )
+
+    csv_bytes = _report_csv_bytes(rows)
     st.download_button(
         "Download Report (CSV)",
         data=csv_bytes,